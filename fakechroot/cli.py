@@ -0,0 +1,174 @@
+# Copyright 2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Command line tool for managing base images
+
+This lets CI build and warm the base images for several distros in parallel
+as a separate step, rather than having the first test to use the fixture
+pay for it.
+"""
+
+from __future__ import print_function
+
+import optparse
+import os
+import sys
+
+from .fakechroot import FakeChrootError, supported_distros
+from .parallel import run_in_parallel
+from .reaper import reap
+
+
+usage = """%prog [options] COMMAND [DISTRO...]
+
+Commands:
+  build    build any missing base images, refresh them, precompute ilists
+           and copy them to the fast filesystem
+  refresh  refresh existing base images, precompute ilists and copy them to
+           the fast filesystem
+  prune    remove base images and their caches
+  verify   check a fixture can be cloned from each base image
+  reap     remove fixtures, faked daemons and locks left by killed test runs
+           (this takes no distros)"""
+
+
+def load_fixture(name):
+    """ Import a ``FakeChroot`` subclass from a ``module:Class`` string """
+    if ":" not in name:
+        raise ValueError("'%s' should be of the form 'module:Class'" % name)
+    module_name, class_name = name.split(":", 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def cmd_build(chroot, options):
+    if options.force:
+        chroot.destroy_environment()
+    chroot.prepare()
+    chroot.place_fast_image()
+
+
+def cmd_refresh(chroot, options):
+    if not os.path.exists(chroot.base_path):
+        raise FakeChrootError("No base image at '%s'" % chroot.base_path)
+    chroot.prepare()
+    chroot.place_fast_image()
+
+
+def cmd_prune(chroot, options):
+    chroot.destroy_environment()
+
+
+def cmd_verify(chroot, options):
+    if not os.path.exists(chroot.base_path):
+        raise FakeChrootError("No base image at '%s'" % chroot.base_path)
+    if not os.path.exists(chroot.base_ilist_path):
+        raise FakeChrootError("No ilist at '%s'" % chroot.base_ilist_path)
+
+    chroot.clone()
+    if chroot.call(["/bin/true"]) != 0:
+        raise FakeChrootError("Unable to run '/bin/true' in '%s'" % chroot.base_path)
+
+
+commands = {
+    "build": cmd_build,
+    "refresh": cmd_refresh,
+    "prune": cmd_prune,
+    "verify": cmd_verify,
+}
+
+
+def run(command, fixture, directory, distros, options, jobs):
+    """
+    Run ``command`` against the base image of each distro, ``jobs`` at a time.
+
+    Each distro has its own base image and lock, so they can be worked on
+    concurrently. Returns a dict mapping each failed distro to its traceback.
+    """
+    def run_one(distro):
+        chroot = fixture.create_in_tempdir(directory, distro=distro)
+        try:
+            commands[command](chroot, options)
+        finally:
+            chroot.destroy()
+
+    return run_in_parallel(run_one, distros, jobs)
+
+
+def cmd_reap(fixture, directory, jobs):
+    reaped, failures = reap(directory, fixture, jobs)
+
+    for path in reaped:
+        print("%s: reaped" % path)
+    for path in sorted(failures):
+        print("%s: FAILED" % path, file=sys.stderr)
+        print(failures[path], file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-d", "--directory", default=os.getcwd(),
+                      help="directory that holds the base images [default: %default]")
+    parser.add_option("-f", "--fixture", default="fakechroot:FakeChroot",
+                      help="FakeChroot subclass to use, as module:Class [default: %default]")
+    parser.add_option("-j", "--jobs", type="int", default=len(supported_distros),
+                      help="number of distros to work on at once [default: %default]")
+    parser.add_option("--force", action="store_true", default=False,
+                      help="rebuild base images that already exist")
+    parser.add_option("--fast-path", default=None,
+                      help="fast filesystem, such as /dev/shm, to clone fixtures on "
+                           "[default: $FAKECHROOT_FAST_PATH]")
+
+    options, args = parser.parse_args(argv)
+
+    if not args or args[0] not in list(commands) + ["reap"]:
+        parser.error("Expected one of: %s" % ", ".join(sorted(list(commands) + ["reap"])))
+
+    command, distros = args[0], []
+    for distro in args[1:] or supported_distros:
+        if distro not in supported_distros:
+            parser.error("Unsupported distro '%s'" % distro)
+        # Each base image can only be worked on by one thread at a time
+        if distro not in distros:
+            distros.append(distro)
+
+    if command == "reap" and args[1:]:
+        parser.error("'reap' cleans up after every distro, so doesn't take any")
+
+    try:
+        fixture = load_fixture(options.fixture)
+    except (ImportError, AttributeError, ValueError) as e:
+        parser.error("Unable to load fixture '%s': %s" % (options.fixture, e))
+
+    if options.fast_path:
+        fixture = type(fixture.__name__, (fixture, ), {"fast_path": options.fast_path})
+
+    directory = os.path.realpath(options.directory)
+
+    if command == "reap":
+        return cmd_reap(fixture, directory, options.jobs)
+
+    failures = run(command, fixture, directory, distros, options, options.jobs)
+
+    for distro in distros:
+        if distro in failures:
+            print("%s: FAILED" % distro, file=sys.stderr)
+            print(failures[distro], file=sys.stderr)
+        else:
+            print("%s: ok" % distro)
+
+    return 1 if failures else 0
@@ -13,11 +13,14 @@
 # limitations under the License.
 
 import collections
-import os, glob, signal, shlex, subprocess, tempfile
+import hashlib
+import json
+import os, glob, re, signal, shlex, stat, subprocess, tempfile
 import shutil
 import six
 
 from .lock import Lock, Locked
+from .reaper import get_command, get_host_identity, get_start_time, is_running, reap
 
 
 def to_str(s):
@@ -32,6 +35,45 @@ def to_str(s):
 
 supported_distros = ('lucid', 'precise', 'quantal', 'raring')
 
+# glibc reports a hardlink limit of 127 for filesystems it doesn't know about
+# (such as overlayfs), so that doesn't tell us anything. These ones don't have
+# a limit worth worrying about.
+unknown_link_max = 127
+unlimited_link_filesystems = ('tmpfs', 'ramfs')
+
+
+def get_filesystem_type(path):
+    path = os.path.realpath(path)
+    try:
+        with open("/proc/mounts") as fp:
+            mounts = [line.split() for line in fp]
+    except IOError:
+        return None
+
+    best, fstype = "", None
+    for mount in mounts:
+        mountpoint = mount[1].replace("\\040", " ")
+        if path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/"):
+            if len(mountpoint) >= len(best):
+                best, fstype = mountpoint, mount[2]
+    return fstype
+
+
+def get_link_max(path):
+    """ Returns the most hardlinks a file at ``path`` can have, or ``None`` if we can't tell """
+    if get_filesystem_type(path) in unlimited_link_filesystems:
+        return 2 ** 31 - 1
+    link_max = os.pathconf(path, "PC_LINK_MAX")
+    if link_max == unknown_link_max:
+        return None
+    return link_max
+
+
+def get_free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
 stat_result = collections.namedtuple(
     "stat_result",
     ("st_mode", "st_ino", "st_dev", "st_nlink", "st_uid", "st_gid",
@@ -56,30 +98,105 @@ class FakeChrootError(Exception):
 
 class FakeChroot(object):
 
-    firstrun = True
+    refreshed = set()
+    reaped = set()
     fakerootkey = None
     checked_supported = False
     Exception = RuntimeError
 
-    def __init__(self, path, base_path=None, distro='precise'):
+    # Don't clone an image unless it can take at least this many more clones
+    # (or a quarter of the clones it can take at all, if that is fewer).
+    link_margin = 64
+
+    # How cowdancer-ilistcreate finds the files to protect. Every file in a
+    # clone is a hardlink into the image, so in the image itself we want all
+    # of them, not just the ones with more than one link.
+    base_ilist_find = "find . -xdev \\( -type l -o -type f \\) -print0 | xargs -0 stat --format '%d %i '"
+    clone_ilist_find = "find . -xdev \\( -type l -o -type f \\) -a -links +1 -print0 | xargs -0 stat --format '%d %i '"
+
+    # A fast filesystem such as /dev/shm to keep a copy of the base image on
+    # and to put each fixture's chroot on, and how much space to leave free
+    # on it for the chroots' copy-on-write files.
+    fast_path = os.environ.get("FAKECHROOT_FAST_PATH")
+    fast_reserve = 512 * 1024 * 1024
+
+    def __init__(self, path, base_path=None, distro='precise', fast_path=None):
         self.distro = distro
 
         self.path = path
         self.chroot_path = os.path.join(path, "chroot")
         self.faked_state_path = os.path.join(path, "faked-state")
         self.ilist_path = os.path.join(path, "ilist")
+        self.owner_path = os.path.join(path, "fakechroot-owner")
         self.overlay_dir = os.path.join(path, 'overlay')
 
         self.src_path = os.path.realpath(os.path.join(path, ".."))
-        self.base_path = base_path or os.path.join(self.src_path, "base-image")
+        self.base_path = base_path or os.path.join(self.src_path, "base-image-%s" % distro)
+        self.base_ilist_path = self.base_path + ".ilist"
+        self.base_stats_path = self.base_path + ".stats"
         self.lock_path = self.base_path + ".lock"
 
+        # Another instance might have put this fixture on a fast filesystem
+        owner = self.read_owner() or {}
+        self.fast_path = fast_path or owner.get("fast_path") or self.fast_path
+        if self.fast_path:
+            self.fast_root = self.get_fast_root(self.fast_path, self.src_path)
+            self.fast_chroot_path = os.path.join(self.fast_root, "fixtures", os.path.basename(path))
+            if os.path.isdir(self.fast_chroot_path):
+                self.chroot_path = self.fast_chroot_path
+        else:
+            self.fast_root = self.fast_chroot_path = None
+
         self.faked = None
 
+    @staticmethod
+    def get_fast_root(fast_path, src_path):
+        # Hardlinks can't cross filesystems, so everything that is cloned from
+        # the fast copy of a base image has to live next to it.
+        digest = hashlib.sha1(src_path.encode("utf-8")).hexdigest()
+        return os.path.join(fast_path, "fakechroot-%s" % digest[:12])
+
     @classmethod
-    def create_in_tempdir(cls, parent):
+    def create_in_tempdir(cls, parent, **kwargs):
         path = tempfile.mkdtemp(dir=parent)
-        return cls(path)
+        chroot = cls(path, **kwargs)
+        chroot.write_owner()
+        return chroot
+
+    def write_owner(self):
+        # Record who we belong to so that the reaper can clean up after us if
+        # we are killed before destroy() gets a chance to run
+        owner = get_host_identity()
+        owner["pid"] = os.getpid()
+        owner["start_time"] = get_start_time(owner["pid"])
+        # So the reaper can find our chroot if it isn't next to us
+        owner["fast_path"] = self.fast_path
+        with open(self.owner_path, "w") as fp:
+            json.dump(owner, fp)
+
+    def read_owner(self):
+        try:
+            with open(self.owner_path) as fp:
+                owner = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(owner, dict) or not isinstance(owner.get("pid"), int):
+            return None
+        return owner
+
+    def is_orphaned(self):
+        owner = self.read_owner()
+        if owner is None:
+            # Not a fixture, or one we can't be sure about
+            return False
+
+        # If the owner lives in another container or on another host (or
+        # before a reboot) then its pid means nothing to us, so leave it be
+        for key, value in get_host_identity().items():
+            if owner.get(key) != value:
+                return False
+
+        return not is_running(owner["pid"], owner.get("start_time"))
 
     def _assert_supported(self):
         if FakeChroot.checked_supported:
@@ -100,42 +217,364 @@ class FakeChroot(object):
     def build(self):
         self._assert_supported()
 
-        # The first time we use the fixture per test run we might 'refresh' it
-        # - that means making sure that it actually exists and that the latest code is
-        # deployed in it.
-        if self.firstrun:
-            lock = Lock(self.lock_path)
+        if not os.path.exists(self.owner_path):
+            self.write_owner()
+
+        # Clean up after any previous test runs that were killed before they
+        # could do so themselves.
+        if self.src_path not in FakeChroot.reaped:
+            reap(self.src_path, type(self), fast_paths=[self.fast_path])
+            FakeChroot.reaped.add(self.src_path)
+
+        # The first time we use a base image per test run we might 'refresh'
+        # it - that means making sure that it actually exists and that the
+        # latest code is deployed in it.
+        if self.base_path not in FakeChroot.refreshed:
+            # We only refresh each base environment once, so record it on the
+            # class to make sure any other fixtures pick it up
+            if self.prepare():
+                FakeChroot.refreshed.add(self.base_path)
+
+        self.clone()
+
+    def prepare(self):
+        """
+        Build the base image if it is missing, refresh it and precompute its
+        ilist. The ilist and stats are left alone if refreshing didn't change
+        anything, so an image warmed by ``fakechroot-images`` stays warm.
+
+        Returns ``False`` if another process held the lock, in which case we
+        just wait for it to finish doing the same work.
+        """
+        self._assert_supported()
 
+        lock = Lock(self.lock_path)
+        try:
+            lock.open()
+        except Locked:
+            lock.wait()
+            return False
+
+        try:
+            if not os.path.exists(self.base_path):
+                self.build_environment()
+            self.refresh_environment()
+
+            stats = self.scan_image()
+            previous = self.get_stats()
+            if not previous or previous["version"] != stats["version"] or not os.path.exists(self.base_ilist_path):
+                self.build_ilist()
+                # Any replicas are now out of date, select_image() will
+                # retire them once nothing is cloning them.
+                self.write_stats(stats)
+        finally:
+            lock.close()
+
+        return True
+
+    def _acquire_lock(self):
+        lock = Lock(self.lock_path)
+        while True:
             try:
                 lock.open()
-
-                if not os.path.exists(self.base_path):
-                    self.build_environment()
-
-                self.refresh_environment()
-
-                # We only refresh the base environment once, so
-                # set this on the class to make sure any other fixtures pick it up
-                FakeChroot.firstrun = False
+                return lock
             except Locked:
                 lock.wait()
+
+    def build_ilist(self, image_path=None):
+        # Every file in a 'cp -al' clone is a hardlink to the same inode in the
+        # base image, so the ilist cow-shell would generate for a clone can be
+        # generated once against the base image and then just copied.
+        image_path = image_path or self.base_path
+        tmp_path = image_path + ".ilist.tmp"
+        subprocess.check_call([
+            "cowdancer-ilistcreate",
+            tmp_path,
+            self.base_ilist_find,
+            ], cwd=image_path)
+        os.rename(tmp_path, image_path + ".ilist")
+
+    def measure_image(self):
+        self.write_stats(self.scan_image())
+
+    def write_stats(self, stats):
+        with open(self.base_stats_path + ".tmp", "w") as fp:
+            json.dump(stats, fp)
+        os.rename(self.base_stats_path + ".tmp", self.base_stats_path)
+
+    def scan_image(self):
+        """
+        Returns how many links the most linked file in the base image has
+        within it, how much space it takes up and a version that changes
+        whenever any of its files do.
+        """
+        # Every clone adds a link to every file in the image, and a file that
+        # is hardlinked n times within the image gets n more links per clone.
+        # Count the paths to each inode ourselves rather than going by
+        # st_nlink, which also includes clones that are still being copied or
+        # destroyed.
+        if not os.path.exists(self.base_path + ".links"):
+            open(self.base_path + ".links", "w").close()
+
+        paths = {}
+        size = 0
+        seen = set()
+        files = []
+        for root, dirnames, filenames in os.walk(self.base_path):
+            for name in dirnames + filenames:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if not stat.S_ISDIR(st.st_mode):
+                    paths[st.st_ino] = paths.get(st.st_ino, 0) + 1
+                if st.st_ino not in seen:
+                    seen.add(st.st_ino)
+                    size += st.st_blocks * 512
+                files.append("%s %d %d %r" % (path, st.st_ino, st.st_size, st.st_mtime))
+
+        version = hashlib.sha1("\n".join(sorted(files)).encode("utf-8")).hexdigest()
+
+        return {
+            "links": max([1] + list(paths.values())),
+            "size": size,
+            "version": version,
+        }
+
+    def get_stats(self, image_path=None):
+        try:
+            with open((image_path or self.base_path) + ".stats") as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def count_clones(self, image_path):
+        # Each image has a counter file next to it. Every clone links to it
+        # (under the lock, before it starts copying) so its link count is the
+        # number of clones that are using the image.
+        try:
+            return os.lstat(image_path + ".links").st_nlink - 1
+        except OSError:
+            return None
+
+    def get_link_capacity(self, image_path):
+        """
+        Returns how many clones ``image_path`` can have before a file in it
+        hits the filesystem's hardlink limit, or ``None`` if we aren't
+        tracking links for this base image.
+        """
+        stats = self.get_stats()
+        if stats is None:
+            return None
+        try:
+            link_max = get_link_max(image_path)
+        except OSError:
+            return None
+        if link_max is None:
+            return None
+        return link_max // stats["links"] - 1
+
+    def get_link_headroom(self, image_path):
+        """
+        Returns how many more times ``image_path`` can be cloned, or ``None``
+        if we aren't tracking links for this base image.
+        """
+        capacity = self.get_link_capacity(image_path)
+        clones = self.count_clones(image_path)
+        if capacity is None or clones is None:
+            return None
+        return capacity - clones
+
+    def has_link_headroom(self, image_path):
+        headroom = self.get_link_headroom(image_path)
+        if headroom is None:
+            return False
+        return headroom > min(self.link_margin, self.get_link_capacity(image_path) // 4)
+
+    def is_current(self, image_path):
+        stats = self.get_stats(image_path)
+        return stats is not None and stats == self.get_stats()
+
+    def get_replicas(self, source=None):
+        source = source or self.base_path
+        replicas = {}
+        for path in glob.glob(source + ".replica-*"):
+            match = re.match(r".*\.replica-(\d+)$", path)
+            if match:
+                replicas[int(match.group(1))] = path
+        return [replicas[i] for i in sorted(replicas)]
+
+    def create_replica(self, source=None):
+        source = source or self.base_path
+        replicas = self.get_replicas(source)
+        index = 1
+        while "%s.replica-%d" % (source, index) in replicas:
+            index += 1
+        path = "%s.replica-%d" % (source, index)
+
+        # A real copy rather than a farm of hardlinks, so it has a fresh set
+        # of inodes to link to
+        self.copy_image(source, path)
+        self.build_ilist(path)
+        open(path + ".links", "w").close()
+        shutil.copyfile(self.base_stats_path, path + ".stats")
+        return path
+
+    def copy_image(self, source, path):
+        subprocess.check_call(["cp", "-a", source, path + ".tmp"])
+        os.rename(path + ".tmp", path)
+
+    def remove_replicas(self, replicas):
+        for path in replicas:
+            subprocess.check_call(["rm", "-rf", path] + glob.glob(path + ".*"))
+
+    def select_image(self, source=None):
+        """
+        Returns the base image (or its copy on the fast filesystem, if
+        ``source`` is given) or replica of it that the next clone should be
+        made from.
+
+        The first one with enough link headroom is used, and a new replica is
+        made if none of them have any. Idle replicas that are out of date or
+        beyond a single spare are retired.
+
+        The clone is counted against the image before the lock is released,
+        so that nothing retires the image while it is being copied.
+        """
+        source = source or self.base_path
+
+        lock = self._acquire_lock()
+        try:
+            if self.get_link_headroom(source) is None:
+                selected = source
             else:
-                lock.close()
+                selected = None
+                idle = []
+                spare = None
+                for image in [source] + self.get_replicas(source):
+                    current = image == source or self.is_current(image)
+                    if selected is None and current and self.has_link_headroom(image):
+                        selected = image
+                    elif image != source and self.count_clones(image) == 0:
+                        if current and spare is None:
+                            spare = image
+                        else:
+                            idle.append(image)
+
+                self.remove_replicas(idle)
+
+                if selected is None:
+                    selected = spare or self.create_replica(source)
+
+            if os.path.exists(selected + ".links"):
+                if os.path.exists(self.chroot_path + ".links"):
+                    os.unlink(self.chroot_path + ".links")
+                os.link(selected + ".links", self.chroot_path + ".links")
+        finally:
+            lock.close()
+
+        return selected
+
+    def get_fast_images(self):
+        images = []
+        pattern = re.compile(re.escape(os.path.basename(self.base_path)) + r"-[0-9a-f]{12}$")
+        for path in glob.glob(os.path.join(self.fast_root, os.path.basename(self.base_path) + "-*")):
+            if pattern.match(os.path.basename(path)):
+                images.append(path)
+        return sorted(images)
+
+    def place_fast_image(self):
+        """
+        Make sure there is a copy of the current version of the base image on
+        the fast filesystem, copying it if the base image has changed.
+
+        Returns the path to the copy, or ``None`` if there isn't room on the
+        fast filesystem for one or it couldn't be copied there.
+        """
+        if not self.fast_path:
+            return None
+
+        stats = self.get_stats()
+        if stats is None:
+            return None
+
+        # Each version of the base image gets its own copy, so that an old one
+        # can be left alone until nothing is cloning it any more.
+        fast_base_path = "%s-%s" % (
+            os.path.join(self.fast_root, os.path.basename(self.base_path)),
+            stats["version"][:12],
+        )
+
+        lock = self._acquire_lock()
+        try:
+            if self.get_stats(fast_base_path) == stats:
+                return fast_base_path
+
+            if not os.path.isdir(self.fast_root):
+                os.makedirs(self.fast_root)
 
+            for image in self.get_fast_images():
+                if image != fast_base_path and self.is_idle(image):
+                    self.remove_replicas(self.get_replicas(image) + [image])
+
+            if get_free_space(self.fast_root) < stats["size"] + self.fast_reserve:
+                return None
+
+            subprocess.check_call(["rm", "-rf", fast_base_path, fast_base_path + ".tmp"])
+            try:
+                self.copy_image(self.base_path, fast_base_path)
+                self.build_ilist(fast_base_path)
+                open(fast_base_path + ".links", "w").close()
+                shutil.copyfile(self.base_stats_path, fast_base_path + ".stats")
+            except (subprocess.CalledProcessError, EnvironmentError):
+                # Something else (such as the base image of another distro)
+                # filled the fast filesystem since we checked, so don't leave
+                # a partial copy taking up memory and fall back to disk
+                subprocess.check_call(["rm", "-rf", fast_base_path] + glob.glob(fast_base_path + ".*"))
+                return None
+        finally:
+            lock.close()
+
+        return fast_base_path
+
+    def is_idle(self, image_path):
+        """ Returns ``True`` if nothing is cloning ``image_path`` or any of its replicas """
+        for image in [image_path] + self.get_replicas(image_path):
+            if self.count_clones(image) not in (0, None):
+                return False
+        return True
+
+    def clone(self):
         # Each fixture gets its own directory. In theory this allows us to run
         # tests in parallel...
 
+        # If there is room on the fast filesystem then clone the copy of the
+        # base image there, otherwise fall back to the one on disk.
+        source = self.place_fast_image()
+        if source and get_free_space(self.fast_root) >= self.fast_reserve:
+            self.chroot_path = self.fast_chroot_path
+            try:
+                os.makedirs(os.path.dirname(self.chroot_path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(self.chroot_path)):
+                    raise
+        else:
+            source = None
+
+        image_path = self.select_image(source)
+
         # Clone the base-image - we use 'cp -al' because we won't the clone to
         # be made out of hardlinks.
-        subprocess.check_call(["cp", "-al", self.base_path, self.chroot_path])
+        subprocess.check_call(["cp", "-al", image_path, self.chroot_path])
 
-        # This is the same delightful incantation used in cow-shell to setup an
-        # .ilist file for our fakechroot.
-        subprocess.check_call([
-            "cowdancer-ilistcreate",
-            self.ilist_path,
-            "find . -xdev \( -type l -o -type f \) -a -links +1 -print0 | xargs -0 stat --format '%d %i '",
-            ], cwd=self.chroot_path)
+        if os.path.exists(image_path + ".ilist"):
+            shutil.copyfile(image_path + ".ilist", self.ilist_path)
+        else:
+            # This is the same delightful incantation used in cow-shell to setup an
+            # .ilist file for our fakechroot.
+            subprocess.check_call([
+                "cowdancer-ilistcreate",
+                self.ilist_path,
+                self.clone_ilist_find,
+                ], cwd=self.chroot_path)
 
         # This is really annoying. Setuptools doesnt preserve permissions. So booo.
         overlay_src = os.path.join(os.path.dirname(__file__), "overlay")
@@ -172,6 +611,22 @@ class FakeChroot(object):
         # Ths hook lets subclasses do stuff to the fakechroot base image once per test suite invocation
         pass
 
+    def destroy_environment(self):
+        lock = self._acquire_lock()
+        try:
+            subprocess.check_call(["rm", "-rf"] + glob.glob(self.base_path + ".replica-*"))
+            if self.fast_path:
+                for image in self.get_fast_images():
+                    self.remove_replicas(self.get_replicas(image) + [image])
+            for path in (self.base_ilist_path, self.base_stats_path, self.base_path + ".links"):
+                if os.path.exists(path):
+                    os.unlink(path)
+            # shutil.rmtree has disappeared up itself deleting large base images
+            if os.path.exists(self.base_path):
+                subprocess.check_call(["rm", "-rf", self.base_path])
+        finally:
+            lock.close()
+
     def get_session(self):
         if self.fakerootkey:
             return self.fakerootkey
@@ -201,11 +656,9 @@ class FakeChroot(object):
 
         env = {}
 
-        path = os.path.realpath(os.path.join(self.chroot_path, "..", ".."))
-
         env['FAKECHROOT'] = 'true'
         env['FAKECHROOT_EXCLUDE_PATH'] = ":".join([
-            '/dev', '/proc', '/sys', path,
+            '/dev', '/proc', '/sys', self.src_path,
             ])
         env['FAKECHROOT_CMD_SUBST'] = ":".join([
             '/usr/sbin/chroot=/usr/sbin/chroot.fakechroot',
@@ -449,9 +902,23 @@ class FakeChroot(object):
             self.get_session()
 
         if self.faked:
-            os.kill(int(self.faked.strip()), signal.SIGTERM)
+            pid = int(self.faked.strip())
+            # Don't trust a pid that has been recycled by something else
+            if is_running(pid) and get_command(pid) in (None, "faked-sysv"):
+                os.kill(pid, signal.SIGTERM)
+            else:
+                self.cleanup_ipc()
             self.faked = None
 
+    def cleanup_ipc(self):
+        # faked-sysv talks over a pair of message queues and a semaphore keyed
+        # off FAKEROOTKEY. It removes them when it exits, but not if it is
+        # SIGKILLed.
+        key = int(self.fakerootkey)
+        with open(os.devnull, "w") as devnull:
+            for flag, ipc_key in (("-Q", key), ("-Q", key + 1), ("-S", key + 2)):
+                subprocess.call(["ipcrm", flag, str(ipc_key)], stdout=devnull, stderr=devnull)
+
     def destroy(self):
         self.cleanup_session()
         if os.path.exists(self.faked_state_path):
@@ -461,5 +928,7 @@ class FakeChroot(object):
         # shutil.rmtree has disappeared up itself deleting large base images
         if os.path.exists(self.chroot_path):
             subprocess.check_call(["rm", "-rf", self.chroot_path])
+        if os.path.exists(self.chroot_path + ".links"):
+            os.unlink(self.chroot_path + ".links")
         if os.path.exists(self.path):
             shutil.rmtree(self.path)
@@ -18,15 +18,34 @@ Simple locking strategy
 This is used to prevent races when using a multi-process test runner.
 """
 
+import json
 import os
+import socket
 import time
-import six
 
 
 class Locked(Exception):
     pass
 
 
+def get_host_identity():
+    """ Returns where our pids mean something: the host, its boot and our pid namespace """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as fp:
+            boot_id = fp.read().strip()
+    except (IOError, OSError):
+        boot_id = None
+    try:
+        pid_namespace = os.readlink("/proc/self/ns/pid")
+    except (OSError, AttributeError):
+        pid_namespace = None
+    return {
+        "hostname": socket.gethostname(),
+        "boot_id": boot_id,
+        "pid_namespace": pid_namespace,
+    }
+
+
 class Lock(object):
 
     def __init__(self, path):
@@ -49,7 +68,9 @@ class Lock(object):
                 time.sleep(0.1)
             raise
 
-        os.write(self.fp, six.binary_type(os.getpid()))
+        # The pid goes first, followed by where it means something
+        contents = "%d\n%s" % (os.getpid(), json.dumps(get_host_identity()))
+        os.write(self.fp, contents.encode("ascii"))
 
     def close(self):
         if self.fp:
@@ -63,7 +84,7 @@ class Lock(object):
             return False
 
         try:
-            pid = int(open(self.path).read())
+            pid = int(open(self.path).read().split("\n", 1)[0])
         except ValueError:
             return False
         except IOError:
@@ -80,6 +101,17 @@ class Lock(object):
 
         return True
 
+    def owner(self):
+        """ Returns the host identity of whoever holds the lock, or ``None`` if it doesn't say """
+        try:
+            with open(self.path) as fp:
+                identity = json.loads(fp.read().split("\n", 1)[1])
+        except (IOError, IndexError, ValueError):
+            return None
+        if not isinstance(identity, dict):
+            return None
+        return identity
+
     def wait(self):
         while self.locked():
             time.sleep(0.1)
@@ -0,0 +1,55 @@
+# Copyright 2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Simple thread pool
+
+Most of the work we do in parallel is waiting on subprocesses and disk, so
+threads are plenty.
+"""
+
+import threading
+import traceback
+
+
+def run_in_parallel(func, items, jobs):
+    """
+    Call ``func`` on each of ``items``, ``jobs`` at a time.
+
+    Returns a dict mapping each item that raised to its traceback.
+    """
+    pending = list(items)
+    failures = {}
+    mutex = threading.Lock()
+
+    def worker():
+        while True:
+            with mutex:
+                if not pending:
+                    return
+                item = pending.pop(0)
+
+            try:
+                func(item)
+            except (Exception, SystemExit):
+                with mutex:
+                    failures[item] = traceback.format_exc()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, jobs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return failures
@@ -0,0 +1,203 @@
+# Copyright 2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Clean up after test runs that were killed
+
+If a test run is SIGKILLed or times out then ``destroy()`` never runs, leaving
+behind the fixture directories, their ``faked-sysv`` daemons (and the SysV
+IPC objects they own) and stale lock files. Every fixture records the pid and
+start time of the process that owns it, so anything whose owner has gone away
+can be safely removed.
+
+Pids only mean something within one pid namespace on one boot of one host,
+so fixtures and locks are only reaped by processes that can see their owner.
+"""
+
+import errno
+import glob
+import os
+import subprocess
+import time
+import uuid
+
+from .lock import Lock, get_host_identity
+from .parallel import run_in_parallel
+
+
+# A lock file is created before the pid is written to it, so give it some
+# time before deciding it is stale.
+stale_lock_age = 60
+
+
+def get_start_time(pid):
+    """ Returns the start time of ``pid`` in clock ticks since boot, or ``None`` if it can't be found """
+    try:
+        with open("/proc/%d/stat" % pid) as fp:
+            # The command name is in brackets and can contain spaces
+            return int(fp.read().rsplit(")", 1)[1].split()[19])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def get_command(pid):
+    """ Returns the name of the command ``pid`` is running, or ``None`` if it can't be found """
+    try:
+        with open("/proc/%d/comm" % pid) as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def is_running(pid, start_time=None):
+    """
+    Returns ``True`` if ``pid`` exists. If ``start_time`` is given then it
+    must also match, so that a recycled pid isn't mistaken for the original.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+
+    if start_time is not None:
+        return get_start_time(pid) in (None, start_time)
+
+    return True
+
+
+def find_orphans(directory, fixture):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            chroot = fixture(path)
+            if chroot.is_orphaned():
+                yield chroot
+
+
+def find_fast_paths(directory, fixture):
+    # Fixtures can be given a fast filesystem of their own, which they record
+    # along with their owner
+    fast_paths = set()
+    if fixture.fast_path:
+        fast_paths.add(fixture.fast_path)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            fast_path = (fixture(path).read_owner() or {}).get("fast_path")
+            if fast_path:
+                fast_paths.add(fast_path)
+    return fast_paths
+
+
+def find_orphaned_fast_chroots(directory, fixture, fast_paths):
+    # A fixture's chroot on the fast filesystem is removed before its
+    # directory is, so any without one have been left behind.
+    for fast_path in sorted(fast_paths):
+        fixtures = os.path.join(fixture.get_fast_root(fast_path, os.path.realpath(directory)), "fixtures")
+        if not os.path.isdir(fixtures):
+            continue
+        for name in os.listdir(fixtures):
+            if name.endswith(".links"):
+                name = name[:-len(".links")]
+            if not os.path.exists(os.path.join(directory, name)):
+                yield os.path.join(fixtures, name)
+
+
+def is_stale_lock(path):
+    try:
+        if time.time() - os.path.getmtime(path) < stale_lock_age:
+            return False
+        lock = Lock(path)
+        # As with fixtures, a lock taken in another container or on another
+        # host (or one that doesn't say where it was taken) might be held by
+        # a pid we can't see, so leave it be
+        if lock.owner() != get_host_identity():
+            return False
+        return not lock.locked()
+    except AssertionError:
+        # We hold it
+        return False
+    except OSError:
+        # Someone else cleaned it up
+        return False
+
+
+def find_stale_locks(directory):
+    for path in glob.glob(os.path.join(directory, "*.lock")):
+        if is_stale_lock(path):
+            yield path
+
+
+def remove_stale_lock(path):
+    """
+    Remove the lock at ``path`` if it is still stale, returning ``True`` if it
+    was removed.
+
+    Another reaper might have removed it since we looked and someone might
+    have taken a fresh lock in its place, so move it aside atomically and
+    check that what we moved is really the stale lock before deleting it.
+    """
+    aside = "%s.reap-%s" % (path, uuid.uuid4().hex)
+    try:
+        os.rename(path, aside)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+    if is_stale_lock(aside):
+        os.unlink(aside)
+        return True
+
+    # We caught a live lock. Put it back unless someone has already taken
+    # the lock again, in which case its owner will find it gone when it
+    # closes it.
+    try:
+        os.link(aside, path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    os.unlink(aside)
+    return False
+
+
+def reap(directory, fixture, jobs=4, fast_paths=()):
+    """
+    Remove the orphaned fixtures and stale locks in ``directory``, and any
+    chroots left on the fast filesystems in ``fast_paths`` (as well as any
+    the fixtures in ``directory`` use).
+
+    Returns a list of the paths that were reaped and a dict mapping any that
+    couldn't be to a traceback.
+    """
+    fast_paths = find_fast_paths(directory, fixture).union(path for path in fast_paths if path)
+
+    orphans = list(find_orphans(directory, fixture))
+    failures = run_in_parallel(lambda chroot: chroot.destroy(), orphans, jobs)
+    failures = dict((chroot.path, tb) for (chroot, tb) in failures.items())
+
+    reaped = [chroot.path for chroot in orphans if chroot.path not in failures]
+
+    fast_chroots = sorted(set(find_orphaned_fast_chroots(directory, fixture, fast_paths)))
+    fast_failures = run_in_parallel(
+        lambda path: subprocess.check_call(["rm", "-rf", path, path + ".links"]), fast_chroots, jobs)
+    failures.update(fast_failures)
+    reaped.extend(path for path in fast_chroots if path not in fast_failures)
+
+    for path in find_stale_locks(directory):
+        if remove_stale_lock(path):
+            reaped.append(path)
+
+    return reaped, failures
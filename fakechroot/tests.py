@@ -12,7 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .unittest2 import TestCase
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import six
+
+from .unittest2 import TestCase, unittest
+from . import cli, reaper
+from .fakechroot import FakeChroot, get_filesystem_type, get_link_max
+from .lock import Lock
 
 
 class TestFakeChrootFixture(TestCase):
@@ -94,3 +107,560 @@ class TestFakeChrootFixture(TestCase):
 
     def test_getspnam_KeyError(self):
         self.assertRaises(KeyError, self.chroot.getspnam, "nobodo")
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def test_load_fixture(self):
+        self.assertEqual(cli.load_fixture("fakechroot:FakeChroot"), FakeChroot)
+
+    def test_load_fixture_ValueError(self):
+        self.assertRaises(ValueError, cli.load_fixture, "fakechroot.FakeChroot")
+
+    def test_unknown_command(self):
+        self.assertRaises(SystemExit, cli.main, ["frobnicate"])
+
+    def test_unsupported_distro(self):
+        self.assertRaises(SystemExit, cli.main, ["build", "warty"])
+
+    def test_reap_takes_no_distros(self):
+        self.assertRaises(SystemExit, cli.main, ["reap", "precise"])
+
+    def test_duplicate_distros(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.mkdir(os.path.join(directory, "base-image-precise"))
+
+        stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        try:
+            result = cli.main([
+                "--directory", directory,
+                "--fixture", "fakechroot.tests:HandmadeFakeChroot",
+                "prune", "precise", "precise",
+                ])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(result, 0)
+        self.assertEqual(output, "precise: ok\n")
+
+    def test_bad_directory_fails(self):
+        self.assertEqual(cli.main(["--directory", "/nonexistent", "prune", "precise"]), 1)
+
+    def test_run(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for distro in ("lucid", "precise"):
+            os.mkdir(os.path.join(directory, "base-image-%s" % distro))
+
+        failures = cli.run("prune", HandmadeFakeChroot, directory, ["lucid", "precise"], None, 2)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_run_failures(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        failures = cli.run("refresh", HandmadeFakeChroot, directory, ["lucid", "precise"], None, 2)
+
+        self.assertEqual(sorted(failures), ["lucid", "precise"])
+        self.assertTrue("No base image" in failures["lucid"])
+
+
+def run_shell(command, cwd):
+    p = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    return stdout
+
+
+class HandmadeFakeChroot(FakeChroot):
+
+    """ A fixture with a tiny base image that doesn't need debootstrap """
+
+    def __init__(self, *args, **kwargs):
+        super(HandmadeFakeChroot, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def _assert_supported(self):
+        pass
+
+    def build_environment(self):
+        self.calls.append("build_environment")
+        os.makedirs(os.path.join(self.base_path, "bin"))
+        with open(os.path.join(self.base_path, "bin", "gzip"), "w") as fp:
+            fp.write("gzip")
+        os.link(os.path.join(self.base_path, "bin", "gzip"), os.path.join(self.base_path, "bin", "gunzip"))
+        os.symlink("gzip", os.path.join(self.base_path, "bin", "zcat"))
+
+    def build_ilist(self, image_path=None):
+        # cowdancer-ilistcreate isn't available, so just record what it would
+        # have been given
+        self.calls.append("build_ilist")
+        image_path = image_path or self.base_path
+        with open(image_path + ".ilist", "wb") as fp:
+            fp.write(run_shell(self.base_ilist_find, image_path))
+
+
+class TestPrepare(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.chroot = HandmadeFakeChroot.create_in_tempdir(self.directory)
+
+    def test_prepare_builds(self):
+        self.assertEqual(self.chroot.prepare(), True)
+        self.assertEqual(self.chroot.calls, ["build_environment", "build_ilist"])
+        self.assertEqual(os.path.exists(self.chroot.base_ilist_path), True)
+        self.assertEqual(self.chroot.get_stats()["version"], self.chroot.scan_image()["version"])
+        self.assertEqual(os.path.exists(self.chroot.lock_path), False)
+
+    def test_prepare_warm(self):
+        self.chroot.prepare()
+        stats = self.chroot.get_stats()
+
+        chroot = HandmadeFakeChroot.create_in_tempdir(self.directory)
+        chroot.prepare()
+        self.assertEqual(chroot.calls, [])
+        self.assertEqual(chroot.get_stats(), stats)
+
+    def test_prepare_refresh_changes_image(self):
+        self.chroot.prepare()
+
+        chroot = HandmadeFakeChroot.create_in_tempdir(self.directory)
+        chroot.refresh_environment = lambda: open(os.path.join(chroot.base_path, "bin", "new"), "w").close()
+        chroot.prepare()
+        self.assertEqual(chroot.calls, ["build_ilist"])
+
+    def test_prepare_missing_ilist(self):
+        self.chroot.prepare()
+        os.unlink(self.chroot.base_ilist_path)
+
+        chroot = HandmadeFakeChroot.create_in_tempdir(self.directory)
+        chroot.prepare()
+        self.assertEqual(chroot.calls, ["build_ilist"])
+
+    def test_base_ilist_matches_clone_ilist(self):
+        # The ilist precomputed on the base image must protect the same files
+        # as the one cow-shell would compute on each clone
+        self.chroot.prepare()
+        clone = os.path.join(self.directory, "clone")
+        subprocess.check_call(["cp", "-al", self.chroot.base_path, clone])
+
+        with open(self.chroot.base_ilist_path, "rb") as fp:
+            base_ilist = fp.read().split()
+        clone_ilist = run_shell(self.chroot.clone_ilist_find, clone).split()
+
+        self.assertEqual(sorted(base_ilist), sorted(clone_ilist))
+        self.assertEqual(len(base_ilist), 2 * 3)
+
+    def test_destroy_environment(self):
+        self.chroot.prepare()
+        self.chroot.create_replica()
+
+        self.chroot.destroy_environment()
+
+        self.assertEqual(sorted(os.listdir(self.directory)), [os.path.basename(self.chroot.path)])
+
+
+def dead_pid():
+    p = subprocess.Popen(["/bin/true"])
+    p.wait()
+    return p.pid
+
+
+def set_owner(chroot, **changes):
+    with open(chroot.owner_path) as fp:
+        owner = json.load(fp)
+    owner.update(changes)
+    with open(chroot.owner_path, "w") as fp:
+        json.dump(owner, fp)
+
+
+class TestReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_lock(self, path, pid, age=0, **changes):
+        identity = reaper.get_host_identity()
+        identity.update(changes)
+        with open(path, "w") as fp:
+            fp.write("%d\n%s" % (pid, json.dumps(identity)))
+        then = time.time() - age
+        os.utime(path, (then, then))
+
+    def make_orphan(self):
+        chroot = FakeChroot.create_in_tempdir(self.directory)
+        set_owner(chroot, pid=dead_pid(), start_time=None)
+        return chroot
+
+    def test_is_orphaned_false(self):
+        chroot = FakeChroot.create_in_tempdir(self.directory)
+        self.assertEqual(chroot.is_orphaned(), False)
+
+    def test_is_orphaned_true(self):
+        chroot = self.make_orphan()
+        self.assertEqual(chroot.is_orphaned(), True)
+
+    def test_is_orphaned_recycled_pid(self):
+        chroot = FakeChroot.create_in_tempdir(self.directory)
+        set_owner(chroot, start_time=1)
+        self.assertEqual(chroot.is_orphaned(), reaper.get_start_time(os.getpid()) is not None)
+
+    def test_is_orphaned_other_host(self):
+        chroot = self.make_orphan()
+        set_owner(chroot, hostname="elsewhere")
+        self.assertEqual(chroot.is_orphaned(), False)
+
+    def test_is_orphaned_other_pid_namespace(self):
+        chroot = self.make_orphan()
+        set_owner(chroot, pid_namespace="pid:[1]")
+        self.assertEqual(chroot.is_orphaned(), False)
+
+    def test_is_orphaned_not_a_fixture(self):
+        chroot = FakeChroot.create_in_tempdir(self.directory)
+        with open(chroot.owner_path, "w") as fp:
+            fp.write("nonsense")
+        self.assertEqual(chroot.is_orphaned(), False)
+
+    def test_reap(self):
+        live = FakeChroot.create_in_tempdir(self.directory)
+        orphan = self.make_orphan()
+        unowned = tempfile.mkdtemp(dir=self.directory)
+
+        reaped, failures = reaper.reap(self.directory, FakeChroot)
+
+        self.assertEqual(reaped, [orphan.path])
+        self.assertEqual(failures, {})
+        self.assertEqual(os.path.exists(live.path), True)
+        self.assertEqual(os.path.exists(orphan.path), False)
+        self.assertEqual(os.path.exists(unowned), True)
+
+    def test_reap_stale_lock(self):
+        stale = os.path.join(self.directory, "stale.lock")
+        self.write_lock(stale, dead_pid(), age=reaper.stale_lock_age + 1)
+
+        fresh = os.path.join(self.directory, "fresh.lock")
+        with open(fresh, "w") as fp:
+            fp.write("")
+
+        reaped, failures = reaper.reap(self.directory, FakeChroot)
+
+        self.assertEqual(reaped, [stale])
+        self.assertEqual(os.path.exists(fresh), True)
+
+    def test_remove_stale_lock_taken_since(self):
+        # Another reaper removed the stale lock and a live process took it
+        # again before we got to it
+        path = os.path.join(self.directory, "live.lock")
+        p = subprocess.Popen(["sleep", "30"])
+        self.addCleanup(p.wait)
+        self.addCleanup(p.kill)
+        self.write_lock(path, p.pid, age=reaper.stale_lock_age + 1)
+        with open(path) as fp:
+            contents = fp.read()
+
+        self.assertEqual(reaper.remove_stale_lock(path), False)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), contents)
+        self.assertEqual(os.listdir(self.directory), ["live.lock"])
+
+    def test_is_stale_lock_other_pid_namespace(self):
+        path = os.path.join(self.directory, "base-image-precise.lock")
+        self.write_lock(path, dead_pid(), age=reaper.stale_lock_age + 1, pid_namespace="pid:[1]")
+        self.assertEqual(reaper.is_stale_lock(path), False)
+
+    def test_is_stale_lock_without_identity(self):
+        path = os.path.join(self.directory, "base-image-precise.lock")
+        with open(path, "w") as fp:
+            fp.write(str(dead_pid()))
+        then = time.time() - reaper.stale_lock_age - 1
+        os.utime(path, (then, then))
+        self.assertEqual(reaper.is_stale_lock(path), False)
+
+    def test_lock_records_identity(self):
+        lock = Lock(os.path.join(self.directory, "base-image-precise.lock"))
+        lock.open()
+        self.addCleanup(lock.close)
+        self.assertEqual(lock.owner(), reaper.get_host_identity())
+
+    def test_remove_stale_lock_already_gone(self):
+        path = os.path.join(self.directory, "gone.lock")
+        self.assertEqual(reaper.remove_stale_lock(path), False)
+
+
+class NoIlistFakeChroot(FakeChroot):
+
+    def build_ilist(self, image_path=None):
+        pass
+
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.chroot = NoIlistFakeChroot(
+            os.path.join(self.directory, "fixture"),
+            base_path=os.path.join(self.directory, "base-image"),
+        )
+        os.mkdir(self.chroot.path)
+        os.makedirs(os.path.join(self.chroot.base_path, "bin"))
+        open(os.path.join(self.chroot.base_path, "bin", "true"), "w").close()
+        os.link(
+            os.path.join(self.chroot.base_path, "bin", "true"),
+            os.path.join(self.chroot.base_path, "bin", "false"),
+        )
+        self.chroot.measure_image()
+        self.link_max = get_link_max(self.chroot.base_path)
+        if self.link_max is None:
+            self.skipTest("Can't tell the hardlink limit of %s" % self.directory)
+
+    def clone(self, image_path=None):
+        chroot = NoIlistFakeChroot(
+            tempfile.mkdtemp(dir=self.directory),
+            base_path=self.chroot.base_path,
+        )
+        self.assertEqual(chroot.select_image(), image_path or chroot.base_path)
+        subprocess.check_call(["cp", "-al", image_path or chroot.base_path, chroot.chroot_path])
+        return chroot
+
+    def reserve(self, image_path):
+        # A clone that has been counted but hasn't started copying yet
+        path = tempfile.mktemp(dir=self.directory)
+        os.link(image_path + ".links", path + ".links")
+        return path
+
+    def shrink_link_max(self):
+        # Pretend the most linked file has so many links already that only a
+        # handful of clones will fit
+        stats = self.chroot.get_stats()
+        stats["links"] = self.link_max // 9
+        with open(self.chroot.base_stats_path, "w") as fp:
+            json.dump(stats, fp)
+
+    def test_get_link_headroom(self):
+        base_path = self.chroot.base_path
+        self.assertEqual(self.chroot.get_link_headroom(base_path), self.link_max // 2 - 1)
+        self.clone()
+        self.assertEqual(self.chroot.get_link_headroom(base_path), self.link_max // 2 - 2)
+
+    def test_measure_image_with_clones(self):
+        self.clone()
+        self.chroot.measure_image()
+        self.assertEqual(self.chroot.get_link_headroom(self.chroot.base_path), self.link_max // 2 - 2)
+
+    def test_measure_image_with_reserved_clone(self):
+        # Counted, but not copied yet, so the links on disk are behind
+        self.reserve(self.chroot.base_path)
+        self.chroot.measure_image()
+        self.assertEqual(self.chroot.get_stats()["links"], 2)
+        self.assertEqual(self.chroot.get_link_headroom(self.chroot.base_path), self.link_max // 2 - 2)
+        self.assertEqual(self.chroot.select_image(), self.chroot.base_path)
+
+    def test_measure_image_with_many_clones(self):
+        for i in range(3):
+            self.clone()
+        self.chroot.measure_image()
+        self.assertEqual(self.chroot.get_stats()["links"], 2)
+
+    def test_get_link_headroom_untracked(self):
+        os.unlink(self.chroot.base_stats_path)
+        self.assertEqual(self.chroot.get_link_headroom(self.chroot.base_path), None)
+        self.assertEqual(self.chroot.select_image(), self.chroot.base_path)
+
+    def test_link_margin_capped(self):
+        # The margin must not be so large that an image with a low limit is
+        # never used
+        self.shrink_link_max()
+        self.assertEqual(self.chroot.has_link_headroom(self.chroot.base_path), True)
+
+    def test_select_image_base(self):
+        self.assertEqual(self.chroot.select_image(), self.chroot.base_path)
+        self.assertEqual(self.chroot.get_replicas(), [])
+        self.assertEqual(self.chroot.count_clones(self.chroot.base_path), 1)
+
+    def test_select_image_creates_replica(self):
+        self.shrink_link_max()
+        while self.chroot.has_link_headroom(self.chroot.base_path):
+            self.reserve(self.chroot.base_path)
+
+        replica = self.chroot.select_image()
+        self.assertEqual(replica, self.chroot.base_path + ".replica-1")
+        self.assertEqual(self.chroot.count_clones(replica), 1)
+        self.assertEqual(self.chroot.select_image(), replica)
+        self.assertEqual(self.chroot.get_replicas(), [replica])
+
+    def test_select_image_retires_idle_replicas(self):
+        self.chroot.create_replica()
+        self.chroot.create_replica()
+        busy = self.chroot.create_replica()
+        self.reserve(busy)
+
+        self.assertEqual(self.chroot.select_image(), self.chroot.base_path)
+        self.assertEqual(self.chroot.get_replicas(), [
+            self.chroot.base_path + ".replica-1",
+            busy,
+        ])
+
+    def test_select_image_keeps_replicas_being_copied(self):
+        # A clone that has picked a replica but not linked anything in it yet
+        # must stop it being retired
+        spare = self.chroot.create_replica()
+        copying = self.chroot.create_replica()
+        self.reserve(copying)
+
+        self.chroot.select_image()
+        self.assertEqual(self.chroot.get_replicas(), [spare, copying])
+
+    def test_select_image_retires_out_of_date_replicas(self):
+        stale = self.chroot.create_replica()
+        busy = self.chroot.create_replica()
+        self.reserve(busy)
+
+        with open(os.path.join(self.chroot.base_path, "bin", "true"), "w") as fp:
+            fp.write("changed")
+        self.chroot.measure_image()
+
+        self.assertEqual(self.chroot.select_image(), self.chroot.base_path)
+        self.assertEqual(self.chroot.get_replicas(), [busy])
+
+    def test_select_image_skips_out_of_date_replicas(self):
+        self.shrink_link_max()
+        while self.chroot.has_link_headroom(self.chroot.base_path):
+            self.reserve(self.chroot.base_path)
+        stale = self.chroot.select_image()
+
+        stats = self.chroot.get_stats()
+        stats["version"] = "changed"
+        with open(self.chroot.base_stats_path, "w") as fp:
+            json.dump(stats, fp)
+        self.reserve(stale)
+
+        self.assertEqual(self.chroot.select_image(), self.chroot.base_path + ".replica-2")
+
+    def test_destroy_releases_image(self):
+        chroot = self.clone()
+        self.assertEqual(self.chroot.count_clones(self.chroot.base_path), 1)
+        chroot.destroy()
+        self.assertEqual(self.chroot.count_clones(self.chroot.base_path), 0)
+
+
+class FullFakeChroot(NoIlistFakeChroot):
+
+    def copy_image(self, source, path):
+        # Run out of space part way through
+        os.makedirs(os.path.join(path + ".tmp", "etc"))
+        raise subprocess.CalledProcessError(1, ["cp", "-a", source, path + ".tmp"])
+
+
+class TestFastPlacement(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, "src"))
+        os.mkdir(os.path.join(self.directory, "fast"))
+
+        self.chroot = NoIlistFakeChroot.create_in_tempdir(
+            os.path.join(self.directory, "src"),
+            fast_path=os.path.join(self.directory, "fast"),
+        )
+        self.chroot.fast_reserve = 0
+        os.makedirs(os.path.join(self.chroot.base_path, "etc"))
+        with open(os.path.join(self.chroot.base_path, "etc", "hostname"), "w") as fp:
+            fp.write("localhost\n")
+        self.chroot.measure_image()
+
+    def change_base_image(self, hostname):
+        with open(os.path.join(self.chroot.base_path, "etc", "hostname"), "w") as fp:
+            fp.write(hostname)
+        self.chroot.measure_image()
+
+    def test_place_fast_image(self):
+        fast_base_path = self.chroot.place_fast_image()
+        self.assertEqual(os.path.dirname(fast_base_path), self.chroot.fast_root)
+        self.assertEqual(os.path.exists(os.path.join(fast_base_path, "etc", "hostname")), True)
+        self.assertEqual(self.chroot.get_stats(fast_base_path), self.chroot.get_stats())
+        self.assertEqual(self.chroot.count_clones(fast_base_path), 0)
+
+    def test_place_fast_image_once_per_version(self):
+        fast_base_path = self.chroot.place_fast_image()
+        inode = os.stat(fast_base_path).st_ino
+        self.assertEqual(self.chroot.place_fast_image(), fast_base_path)
+        self.assertEqual(os.stat(fast_base_path).st_ino, inode)
+
+        self.change_base_image("otherhost\n")
+
+        new_fast_base_path = self.chroot.place_fast_image()
+        self.assertNotEqual(new_fast_base_path, fast_base_path)
+        with open(os.path.join(new_fast_base_path, "etc", "hostname")) as fp:
+            self.assertEqual(fp.read(), "otherhost\n")
+        self.assertEqual(self.chroot.get_fast_images(), [new_fast_base_path])
+
+    def test_place_fast_image_keeps_old_version_in_use(self):
+        old = self.chroot.place_fast_image()
+        self.assertEqual(self.chroot.select_image(old), old)
+
+        self.change_base_image("otherhost\n")
+        new = self.chroot.place_fast_image()
+
+        self.assertEqual(sorted(self.chroot.get_fast_images()), sorted([old, new]))
+
+        os.unlink(self.chroot.chroot_path + ".links")
+        self.change_base_image("thirdhost\n")
+        newest = self.chroot.place_fast_image()
+        self.assertEqual(self.chroot.get_fast_images(), [newest])
+
+    def test_place_fast_image_no_room(self):
+        self.chroot.fast_reserve = 2 ** 62
+        self.assertEqual(self.chroot.place_fast_image(), None)
+        self.assertEqual(self.chroot.get_fast_images(), [])
+
+    def test_place_fast_image_copy_fails(self):
+        chroot = FullFakeChroot(self.chroot.path)
+        self.assertEqual(chroot.place_fast_image(), None)
+        self.assertEqual(os.listdir(chroot.fast_root), [])
+
+    def test_place_fast_image_not_configured(self):
+        chroot = NoIlistFakeChroot(
+            os.path.join(self.directory, "src", "unowned"),
+            base_path=self.chroot.base_path,
+        )
+        self.assertEqual(chroot.place_fast_image(), None)
+
+    def test_fast_path_from_owner(self):
+        chroot = NoIlistFakeChroot(self.chroot.path)
+        self.assertEqual(chroot.fast_path, self.chroot.fast_path)
+
+    def test_reap_orphaned_fast_chroot(self):
+        orphan = os.path.join(self.chroot.fast_root, "fixtures", "tmp-gone")
+        os.makedirs(orphan)
+        os.makedirs(self.chroot.fast_chroot_path)
+        self.assertEqual(NoIlistFakeChroot(self.chroot.path).chroot_path, self.chroot.fast_chroot_path)
+
+        # Only the fixture knows about the fast filesystem, not the class
+        reaped, failures = reaper.reap(os.path.join(self.directory, "src"), NoIlistFakeChroot)
+
+        self.assertEqual(reaped, [orphan])
+        self.assertEqual(os.path.exists(orphan), False)
+        self.assertEqual(os.path.exists(self.chroot.fast_chroot_path), True)
+
+    def test_reap_orphaned_fast_fixture(self):
+        os.makedirs(self.chroot.fast_chroot_path)
+        set_owner(self.chroot, pid=dead_pid(), start_time=None)
+
+        reaped, failures = reaper.reap(os.path.join(self.directory, "src"), NoIlistFakeChroot)
+
+        self.assertEqual(reaped, [self.chroot.path])
+        self.assertEqual(os.path.exists(self.chroot.fast_chroot_path), False)
+
+    @unittest.skipUnless(get_filesystem_type("/dev/shm") == "tmpfs", "/dev/shm is not a tmpfs")
+    def test_get_link_max_tmpfs(self):
+        self.assertTrue(get_link_max("/dev/shm") > 65000)
@@ -31,6 +31,11 @@ setup(name='fakechroot',
           'setuptools',
           'six',
       ],
+      entry_points={
+          'console_scripts': [
+              'fakechroot-images = fakechroot.cli:main',
+          ],
+      },
       extras_require = {
           'test': ['unittest2', 'discover'],
           },